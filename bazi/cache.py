@@ -0,0 +1,42 @@
+import functools
+from collections import namedtuple
+
+from lunar_python import Solar
+
+from .helper import calculate_values, get_hidden_gans, calculate_wuxing_yinyang_for_bazi, calculate_shishen_for_bazi, \
+    get_wang_xiang, calculate_wang_xiang_values, calculate_gan_liang_value, accumulate_wuxing_values, \
+    calculate_shenghao, calculate_shenghao_percentage, analyse_personality, calculate_day_guiren, calculate_tian_de, \
+    calculate_yue_de, calculate_wen_chang, calculate_lu_shen
+
+BaziBundle = namedtuple('BaziBundle', [
+    'bazi', 'values', 'hidden_gans', 'main_wuxing', 'shengxiao', 'wang_xiang', 'wang_xiang_values', 'wuxing',
+    'yinyang', 'shishen', 'gan_liang_values', 'wuxing_value', 'sheng_hao', 'sheng_hao_percentage', 'personality',
+    'gui_ren', 'tian_de', 'yue_de', 'wen_chang', 'lu_shen'
+])
+
+
+@functools.lru_cache(maxsize=4096)
+def compute_bazi(year, month, day, hour, minute):
+    """Everything about a chart that depends only on the birth time, shared by every request for it."""
+    # The bundle is immutable but most of its fields are plain lists and dicts (wang_xiang may even be a module-level
+    # table) handed to every request for this birth time; callers must treat them as read-only.
+    solar = Solar.fromYmdHms(year, month, day, hour, minute, 0)
+    lunar = solar.getLunar()
+    bazi = lunar.getEightChar()
+    main_wuxing = bazi.getDayWuXing()[0]
+    values = calculate_values(bazi)
+    hidden_gans = get_hidden_gans(bazi)
+    wuxing, yinyang = calculate_wuxing_yinyang_for_bazi(bazi)
+    shishen = calculate_shishen_for_bazi(wuxing, yinyang)
+    wang_xiang = get_wang_xiang(bazi.getMonthZhi(), lunar)
+    wang_xiang_values = calculate_wang_xiang_values(bazi, wang_xiang)
+    gan_liang_values = calculate_gan_liang_value(values, hidden_gans, wang_xiang_values)
+    shengxiao = lunar.getYearShengXiaoExact()
+    wuxing_value = accumulate_wuxing_values(wuxing, gan_liang_values)
+    sheng_hao = calculate_shenghao(wuxing_value, main_wuxing)
+    sheng_hao_percentage = calculate_shenghao_percentage(sheng_hao[0], sheng_hao[1])
+    personality = analyse_personality(bazi.getMonthZhi())
+    return BaziBundle(bazi, values, hidden_gans, main_wuxing, shengxiao, wang_xiang, wang_xiang_values, wuxing,
+                      yinyang, shishen, gan_liang_values, wuxing_value, sheng_hao, sheng_hao_percentage, personality,
+                      calculate_day_guiren(bazi), calculate_tian_de(bazi), calculate_yue_de(bazi),
+                      calculate_wen_chang(bazi), calculate_lu_shen(bazi))
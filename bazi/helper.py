@@ -1,16 +1,33 @@
+import calendar
 import datetime
+import functools
+import multiprocessing
+import pathlib
+import sqlite3
 
-import openai
 import os
 from bazi.constants import relationships, wang_xiang_value, gan_wuxing, hidden_gan_ratios, zhi_seasons, season_phases, \
     wuxing_relations, zhi_wuxing, gan_yinyang, peiou_xingge, tigang, liu_he, wu_he, wuxing, gan_xiang_chong, \
     zhi_xiang_chong, gui_ren, tian_de, yue_de, wu_bu_yu_shi, lu_shen
 from lunar_python import Solar, Lunar, EightChar
+from lunar_python.util import LunarUtil
 import csv
 
 from fengshui.settings import DATA_DIR
 
-openai.api_key = os.environ.get('OPENAI_API_KEY')
+
+def group_pairs_by_first(pairs):
+    grouped = {}
+    for first, second in pairs:
+        grouped.setdefault(first, set()).add(second)
+    return grouped
+
+
+# The shensha tables are keyed on one fixed pillar of the chart (day gan or month zhi), so index them
+# once by that side and let each check be a single set lookup.
+gui_ren_by_gan = group_pairs_by_first(gui_ren)
+tian_de_by_month_zhi = group_pairs_by_first(tian_de)
+yue_de_by_month_zhi = group_pairs_by_first(yue_de)
 
 
 def wuxing_relationship(gan, zhi):
@@ -29,11 +46,14 @@ def wuxing_relationship(gan, zhi):
         return 8, 6
 
 
+# Only 10 x 12 gan/zhi pairs exist, so resolve every relationship once instead of per pillar.
+wuxing_relationship_values = {(gan, zhi): wuxing_relationship(gan, zhi) for gan in gan_wuxing for zhi in zhi_wuxing}
+
+
 def calculate_values(bazi):
     values = []
     for item in bazi.toString().split():
-        gan_value, zhi_value = wuxing_relationship(item[0], item[1])
-        values.append((gan_value, zhi_value))
+        values.append(wuxing_relationship_values[item[0], item[1]])
     return values
 
 
@@ -63,11 +83,15 @@ def get_hidden_gans(bazi):
     return hidden_gans_list
 
 
+tu_month_zhis = frozenset({'辰', '未', '戌', '丑'})
+tu_wang_xiang = {'土': '旺', '金': '相', '火': '休', '木': '囚', '水': '死'}
+
+
 def get_wang_xiang(month_zhi, lunar):
     season = zhi_seasons.get(month_zhi)
-    if month_zhi in ['辰', '未', '戌', '丑']:
+    if month_zhi in tu_month_zhis:
         if lunar.getNextJieQi(True).getSolar().subtract(lunar.getSolar()) <= 18:
-            return {'土': '旺', '金': '相', '火': '休', '木': '囚', '水': '死'}
+            return tu_wang_xiang
     return season_phases[season]
 
 
@@ -99,45 +123,40 @@ def calculate_gan_liang_value(values, hidden_gans, wang_xiang_values):
 
     for (v_gan, v_zhi), gans, (wx_gan, wx_zhis) in zip(values, hidden_gans, wang_xiang_values):
         zhi_values = [v_zhi * g * wx for g, wx in zip(gans.values(), wx_zhis)]
-        result.append((v_gan * 1 * wx_gan, zhi_values))
+        result.append((v_gan * wx_gan, zhi_values))
 
     return result
 
 
+all_wuxing = ('木', '火', '土', '金', '水')
+
+
 def accumulate_wuxing_values(wuxing, gan_liang_value):
-    all_wuxing = ['木', '火', '土', '金', '水']
     result = {wx: 0 for wx in all_wuxing}
 
     for (wx_gan, wx_zhis), (gl_gan, gl_zhis) in zip(wuxing, gan_liang_value):
         # Add the gan value
-        result[wx_gan] = result.get(wx_gan, 0) + gl_gan
+        result[wx_gan] += gl_gan
 
         # Add the zhi values
         for wx, gl in zip(wx_zhis, gl_zhis):
-            result[wx] = result.get(wx, 0) + gl
+            result[wx] += gl
 
     return result
 
 
-def calculate_values_for_bazi(bazi, dict):
-    values = []
+def calculate_wuxing_yinyang_for_bazi(bazi):
+    """Wuxing and yinyang of each pillar as (gan value, [hidden gan values]) pairs, one list for each."""
+    wuxing_values = []
+    yinyang_values = []
 
     for item in bazi.toString().split():
         gan, zhi = item[0], item[1]
-
-        # Determine value for gan
-        value_for_gan = dict.get(gan)
-
-        # Determine value for each hidden gan in zhi
         hidden_gans_for_zhi = hidden_gan_ratios.get(zhi)
-        values_for_zhi = []
-        for hidden_gan in hidden_gans_for_zhi.keys():
-            value_for_hidden_gan = dict.get(hidden_gan)
-            values_for_zhi.append(value_for_hidden_gan)
+        wuxing_values.append((gan_wuxing.get(gan), [gan_wuxing.get(hidden) for hidden in hidden_gans_for_zhi]))
+        yinyang_values.append((gan_yinyang.get(gan), [gan_yinyang.get(hidden) for hidden in hidden_gans_for_zhi]))
 
-        values.append((value_for_gan, values_for_zhi))
-
-    return values
+    return wuxing_values, yinyang_values
 
 
 def calculate_shishen(day_master_yinyang, day_master_wuxing, stem_yinyang, stem_wuxing):
@@ -231,12 +250,17 @@ def analyse_partner(hidden_gan, shishen_list):
     return peiou_xingge.get(list(ratios.items())[0][0])
 
 
+@functools.lru_cache(maxsize=128)
+def get_liunian_bazi(year):
+    solar = Solar.fromYmd(year, 5, 5)
+    lunar = solar.getLunar()
+    return lunar.getEightChar()
+
+
 def analyse_liunian(bazi, shishen, selected_year, is_strong, is_male):
     daymaster_wuxing = gan_wuxing.get(bazi.getDayGan())
     daymaster_yinyang = gan_yinyang.get(bazi.getDayGan())
-    solar = Solar.fromYmd(int(selected_year), 5, 5)
-    lunar = solar.getLunar()
-    year_bazi = lunar.getEightChar()
+    year_bazi = get_liunian_bazi(int(selected_year))
     year_shishen = get_shishen_for_that_year(year_bazi, daymaster_wuxing, daymaster_yinyang)
     analysis = f"{year_bazi.getYearGan()}{year_bazi.getYearZhi()}年，对应流年运：{year_shishen}（数字为地支藏干之比例）<br>"
     analysis += "流年天干分析，主要对应上半年：<br>"
@@ -619,10 +643,14 @@ def analyse_personality(month_zhi):
 
 
 def best_bazi_from_to(start_year, end_year):
-    for year in range(start_year, end_year + 1):
-        print('processing year' + str(year))
-        best_bazi_in_year(year)
-        print('finish year ' + str(year))
+    years = range(start_year, end_year + 1)
+    print('processing years ' + str(start_year) + '-' + str(end_year))
+    # Every year writes its own CSV, so the years are scanned in parallel, one task per year.
+    with multiprocessing.Pool() as pool:
+        for year, _ in zip(years, pool.imap(best_bazi_in_year, years, chunksize=1)):
+            print('finish year ' + str(year))
+    # The zeri view ignores an index older than the CSVs, so rebuild it from the fresh data.
+    print('indexed ' + str(build_good_bazi_index()) + ' good bazi times')
 
 
 def best_bazi_in_year(year):
@@ -630,36 +658,156 @@ def best_bazi_in_year(year):
     file_path = os.path.join(DATA_DIR, f"good_bazis_{year}.csv")
     with open(file_path, "w", newline='') as csvfile:
         bazi_writer = csv.writer(csvfile)
-        while lunar.getYear() == year:
+        day = (lunar.getYear(), lunar.getMonth(), lunar.getDay())
+        while day[0] == year:
             solar = lunar.getSolar()
-            if is_bazi_good(Lunar.fromYmdHms(year, lunar.getMonth(), lunar.getDay(), 0, 0, 0).getEightChar(), 0):
-                bazi_writer.writerow([solar.getYear(), solar.getMonth(), solar.getDay(), 0])
-            for i in range(1, 23, 2):
-                if is_bazi_good(Lunar.fromYmdHms(year, lunar.getMonth(), lunar.getDay(), i, 0, 0).getEightChar(),
-                                i):
-                    bazi_writer.writerow([solar.getYear(), solar.getMonth(), solar.getDay(), i])
-            if is_bazi_good(Lunar.fromYmdHms(year, lunar.getMonth(), lunar.getDay(), 23, 0, 0).getEightChar(), 23):
-                bazi_writer.writerow([solar.getYear(), solar.getMonth(), solar.getDay(), 23])
+            ymd = solar.getYear(), solar.getMonth(), solar.getDay()
+            bazi_writer.writerows((*ymd, hour) for hour in good_hours_in_day(lunar))
+            # Around Julian leap days next(1) can land on the same lunar day, so step on until the date changes.
             i = 1
             next_lunar = lunar.next(i)
-            while next_lunar.toString() == lunar.toString():
+            next_day = (next_lunar.getYear(), next_lunar.getMonth(), next_lunar.getDay())
+            while next_day == day:
                 i += 1
                 next_lunar = lunar.next(i)
-            if next_lunar.getMonth() < lunar.getMonth():
+                next_day = (next_lunar.getYear(), next_lunar.getMonth(), next_lunar.getDay())
+            if next_day[1] < day[1]:
                 break
-            lunar = next_lunar
+            lunar, day = next_lunar, next_day
+
+
+# 五鼠遁: the hour pillars of a day run on from 甲子, 丙子, 戊子, 庚子 or 壬子 by day gan; hour 23 takes the 13th.
+hour_ganzhi_by_day_gan = tuple(tuple(LunarUtil.JIA_ZI[(gan % 5 * 12 + index) % 60] for index in range(13))
+                               for gan in range(10))
+# 早子 at 0, the odd hour opening each branch, then 晚子 at 23.
+good_bazi_hours = (0, 1, 3, 5, 7, 9, 11, 13, 15, 17, 19, 21, 23)
+
+
+def good_hours_in_day(lunar):
+    # The scan walks days at 00:00, so the day's own Lunar already carries the first hour's pillars.
+    year, month, day = lunar.getYear(), lunar.getMonth(), lunar.getDay()
+    first = lunar.getEightChar()
+    last = Lunar.fromYmdHms(year, month, day, 23, 0, 0).getEightChar()
+    if first.getYear() != last.getYear() or first.getMonth() != last.getMonth():
+        # A jie falls inside this day, so the month pillar depends on the hour.
+        return [hour for hour in good_bazi_hours
+                if is_bazi_good(Lunar.fromYmdHms(year, month, day, hour, 0, 0).getEightChar(), hour)]
+    year_ganzhi, month_ganzhi, day_ganzhi = first.getYear(), first.getMonth(), first.getDay()
+    hour_ganzhi = hour_ganzhi_by_day_gan[first.getDayGanIndex()]
+    return [hour for hour in good_bazi_hours
+            if is_ganzhi_good((year_ganzhi, month_ganzhi, day_ganzhi, hour_ganzhi[(hour + 1) // 2]), hour)]
+
+
+GOOD_BAZI_INDEX = os.path.join(DATA_DIR, 'good_bazis.sqlite')
+EPOCH = datetime.datetime(1970, 1, 1)
+good_bazi_connection = None
+good_bazi_connection_mtime = None
+
+
+def to_timestamp(date):
+    return calendar.timegm(date.timetuple())
+
+
+def from_timestamp(ts):
+    return EPOCH + datetime.timedelta(seconds=ts)
+
+
+def good_bazi_dates(reader):
+    for row in reader:
+        try:
+            yield datetime.datetime(int(row[0]), int(row[1]), int(row[2]), int(row[3]))
+        except ValueError:
+            # Julian leap days such as 1000-02-29 have no proleptic Gregorian datetime.
+            continue
+
+
+@functools.lru_cache(maxsize=64)
+def good_bazis_in_year(year):
+    """All times listed in good_bazis_{year}.csv, in the chronological order they were written."""
+    try:
+        with open(os.path.join(DATA_DIR, f'good_bazis_{year}.csv'), newline='') as csvfile:
+            return tuple(good_bazi_dates(csv.reader(csvfile)))
+    except FileNotFoundError:
+        return ()
+
+
+@functools.lru_cache(maxsize=1024)
+def lunar_year_span(year):
+    """Return the solar start of lunar year `year` and of the next one; good_bazis_{year}.csv falls in between."""
+    try:
+        start = Lunar.fromYmd(year, 1, 1).getSolar()
+        end = Lunar.fromYmd(year + 1, 1, 1).getSolar()
+        return (datetime.datetime(start.getYear(), start.getMonth(), start.getDay()),
+                datetime.datetime(end.getYear(), end.getMonth(), end.getDay()))
+    except ValueError:
+        # Outside datetime's range (year 0 or 10000), where no data file exists either.
+        return None
+
+
+def build_good_bazi_index():
+    """Load every good_bazis_{year}.csv into a single SQLite table keyed by unix timestamp."""
+    tmp_path = GOOD_BAZI_INDEX + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    with connection:
+        connection.execute('CREATE TABLE good_bazis (ts INTEGER PRIMARY KEY)')
+        for file_name in sorted(os.listdir(DATA_DIR)):
+            if not (file_name.startswith('good_bazis_') and file_name.endswith('.csv')):
+                continue
+            with open(os.path.join(DATA_DIR, file_name), newline='') as csvfile:
+                connection.executemany('INSERT OR IGNORE INTO good_bazis VALUES (?)',
+                                       ((to_timestamp(date),) for date in good_bazi_dates(csv.reader(csvfile))))
+    count = connection.execute('SELECT COUNT(*) FROM good_bazis').fetchone()[0]
+    connection.close()
+    os.replace(tmp_path, GOOD_BAZI_INDEX)
+    return count
+
+
+def newest_good_bazi_csv_mtime():
+    return max((entry.stat().st_mtime for entry in os.scandir(DATA_DIR)
+                if entry.name.startswith('good_bazis_') and entry.name.endswith('.csv')), default=0)
+
+
+def good_bazis_between(from_date, to_date):
+    """Lazily iterate the good bazi times within [from_date, to_date], or return None if there is no usable index."""
+    global good_bazi_connection, good_bazi_connection_mtime
+    try:
+        mtime = os.stat(GOOD_BAZI_INDEX).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime != good_bazi_connection_mtime:
+        # The index was built, rebuilt or removed since it was opened. Only drop the old connection: responses still
+        # streaming from its cursors keep it alive until they finish.
+        good_bazi_connection = None
+        good_bazi_connection_mtime = mtime
+        # An index older than the CSVs was built before the last data reload and would serve stale dates.
+        if mtime is not None and mtime >= newest_good_bazi_csv_mtime():
+            try:
+                good_bazi_connection = sqlite3.connect(pathlib.Path(GOOD_BAZI_INDEX).as_uri() + '?mode=ro', uri=True,
+                                                       check_same_thread=False)
+            except sqlite3.OperationalError:
+                return None
+            good_bazi_connection.execute('PRAGMA mmap_size=268435456')
+    if good_bazi_connection is None:
+        return None
+    rows = good_bazi_connection.execute('SELECT ts FROM good_bazis WHERE ts BETWEEN ? AND ? ORDER BY ts',
+                                        (to_timestamp(from_date), to_timestamp(to_date)))
+    return (from_timestamp(ts) for ts, in rows)
 
 
 def is_bazi_good(bazi: EightChar, hour):
-    return is_bazi_contain_all_wuxing(bazi) and not is_wu_bu_yu_shi(bazi, hour) and not tian_gan_or_di_zhi_xiang_chong(
-        bazi,
-        0) and not tian_gan_or_di_zhi_xiang_chong(
-        bazi, 1)
+    return is_ganzhi_good(bazi.toString().split(), hour)
+
 
+def is_ganzhi_good(ganzhi, hour):
+    return is_bazi_contain_all_wuxing(ganzhi) and not is_wu_bu_yu_shi(ganzhi, hour) and not \
+        tian_gan_or_di_zhi_xiang_chong(ganzhi, 0) and not tian_gan_or_di_zhi_xiang_chong(ganzhi, 1)
 
-def is_bazi_contain_all_wuxing(bazi: EightChar):
+
+def is_bazi_contain_all_wuxing(ganzhi):
     wuxing_big_number = {'金': 0, '木': 0, '水': 0, '火': 0, '土': 0}
-    for tiangan in bazi.toString().split():
+    for tiangan in ganzhi:
         for char in tiangan:
             wuxing_big_number[wuxing[char]] += 1
     for num in wuxing_big_number.values():
@@ -668,22 +816,26 @@ def is_bazi_contain_all_wuxing(bazi: EightChar):
     return True
 
 
-def is_wu_bu_yu_shi(bazi: EightChar, hour):
+def is_wu_bu_yu_shi(ganzhi, hour):
     # return relationships['克'][gan_wuxing[bazi.getTimeGan()]] == gan_wuxing[bazi.getDayGan()] and gan_yinyang[
     #     bazi.getTimeGan()] == gan_yinyang[bazi.getDayGan()]
-    if (bazi.getDayGan(), bazi.getTimeZhi()) in wu_bu_yu_shi:
+    day_gan, time_zhi = ganzhi[2][0], ganzhi[3][1]
+    if (day_gan, time_zhi) in wu_bu_yu_shi:
         return True
-    if bazi.getDayGan() == '戊' and bazi.getTimeZhi() == '子' and hour >= 23:
+    if day_gan == '戊' and time_zhi == '子' and hour >= 23:
         return True
     return False
 
 
-def tian_gan_or_di_zhi_xiang_chong(bazi: EightChar, get_gan=0):
-    clashing_pair = {0: gan_xiang_chong, 1: zhi_xiang_chong}
-    gan = get_gan_or_zhi(bazi, get_gan)
+clashing_pair = {0: gan_xiang_chong, 1: zhi_xiang_chong}
+
+
+def tian_gan_or_di_zhi_xiang_chong(ganzhi, get_gan=0):
+    clashing = clashing_pair[get_gan]
+    gan = [pillar[get_gan] for pillar in ganzhi]
     for i in range(len(gan)):
         for j in range(i + 1, len(gan)):
-            if (gan[i], gan[j]) in clashing_pair[get_gan]:
+            if (gan[i], gan[j]) in clashing:
                 return True
     return False
 
@@ -696,55 +848,55 @@ def get_gan_or_zhi(bazi: EightChar, get_gan=0):
 
 
 def calculate_day_guiren(bazi: EightChar):
-    ri_yuan = bazi.getDayGan()
+    ri_yuan_gui_ren = gui_ren_by_gan.get(bazi.getDayGan(), set())
     zhi = get_gan_or_zhi(bazi, 1)
     day_guiren = 0
     for i in range(len(zhi)):
-        if (ri_yuan, zhi[i]) in gui_ren:
+        if zhi[i] in ri_yuan_gui_ren:
             day_guiren += 1
     return day_guiren
 
 
 def calculate_year_guiren(bazi: EightChar):
-    year_gan = bazi.getYearGan()
+    year_gan_gui_ren = gui_ren_by_gan.get(bazi.getYearGan(), set())
     zhi = get_gan_or_zhi(bazi, 1)
     year_guiren = 0
     for i in range(len(zhi)):
-        if (year_gan, zhi[i]) in gui_ren:
+        if zhi[i] in year_gan_gui_ren:
             year_guiren += 1
     return year_guiren
 
 
 def calculate_tian_de(bazi: EightChar):
-    month_zhi = bazi.getMonthZhi()
+    month_tian_de = tian_de_by_month_zhi.get(bazi.getMonthZhi(), set())
     ganzhi = bazi.toString().split()
     ganzhi.pop(1)
     total_tian_de = 0
     for gz in ganzhi:
         for i in range(2):
-            if (month_zhi, ganzhi[i]) in tian_de:
+            if ganzhi[i] in month_tian_de:
                 total_tian_de += 1
     return total_tian_de
 
 
 def calculate_yue_de(bazi: EightChar):
-    month_zhi = bazi.getMonthZhi()
+    month_yue_de = yue_de_by_month_zhi.get(bazi.getMonthZhi(), set())
     ganzhi = bazi.toString().split()
     ganzhi.pop(1)
     total_yue_de = 0
     for gz in ganzhi:
         for i in range(2):
-            if (month_zhi, ganzhi[i]) in yue_de:
+            if ganzhi[i] in month_yue_de:
                 total_yue_de += 1
     return total_yue_de
 
 
 def calculate_wen_chang(bazi: EightChar):
     total_wen_chang = 0
-    ri_yuan = bazi.getDayGan()
+    ri_yuan_gui_ren = gui_ren_by_gan.get(bazi.getDayGan(), set())
     zhi = get_gan_or_zhi(bazi, 1)
     for i in range(len(zhi)):
-        if (ri_yuan, zhi[i]) in gui_ren:
+        if zhi[i] in ri_yuan_gui_ren:
             total_wen_chang += 1
     return total_wen_chang
 
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from bazi.helper import build_good_bazi_index, GOOD_BAZI_INDEX
+
+
+class Command(BaseCommand):
+    help = 'Index the good_bazis_{year}.csv files into a SQLite database used by the zeri view'
+
+    def handle(self, *args, **options):
+        count = build_good_bazi_index()
+
+        self.stdout.write(self.style.SUCCESS(f'Successfully indexed {count} good bazi times into {GOOD_BAZI_INDEX}.'))
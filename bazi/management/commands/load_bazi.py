@@ -1,6 +1,4 @@
 from django.core.management.base import BaseCommand
-import csv
-import os
 from bazi.helper import best_bazi_from_to
 
 
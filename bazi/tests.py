@@ -1,3 +1,101 @@
-from django.test import TestCase
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from lunar_python import Lunar, Solar
+
+from bazi import helper
+from bazi.views import _good_bazis_from_csv
+from fengshui.settings import DATA_DIR
+
+
+class GoodBaziIndexTest(SimpleTestCase):
+    years = (1580, 1581, 1582, 1583, 1584, 2022, 2023, 2024, 2025, 2026)
+    ranges = (
+        (datetime.datetime(1582, 10, 1), datetime.datetime(1582, 10, 31)),
+        (datetime.datetime(1581, 6, 1), datetime.datetime(1583, 6, 1)),
+        (datetime.datetime(2023, 12, 20), datetime.datetime(2024, 2, 20)),
+        (datetime.datetime(2024, 1, 1), datetime.datetime(2024, 12, 31)),
+        (datetime.datetime(2024, 2, 10), datetime.datetime(2024, 2, 10)),
+    )
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        for year in self.years:
+            shutil.copy(os.path.join(DATA_DIR, f'good_bazis_{year}.csv'), self.data_dir)
+        for name, value in (('DATA_DIR', self.data_dir),
+                            ('GOOD_BAZI_INDEX', os.path.join(self.data_dir, 'good_bazis.sqlite')),
+                            ('good_bazi_connection', None), ('good_bazi_connection_mtime', None)):
+            patcher = mock.patch.object(helper, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        helper.good_bazis_in_year.cache_clear()
+        self.addCleanup(helper.good_bazis_in_year.cache_clear)
+        self.addCleanup(lambda: helper.good_bazi_connection and helper.good_bazi_connection.close())
+
+    def test_index_matches_csv_fallback(self):
+        self.assertIsNone(helper.good_bazis_between(*self.ranges[0]))
+        helper.build_good_bazi_index()
+        for from_date, to_date in self.ranges:
+            with self.subTest(from_date=from_date, to_date=to_date):
+                self.assertEqual(list(helper.good_bazis_between(from_date, to_date)),
+                                 _good_bazis_from_csv(from_date, to_date))
+
+    def test_index_older_than_csvs_is_ignored(self):
+        helper.build_good_bazi_index()
+        self.assertIsNotNone(helper.good_bazis_between(*self.ranges[0]))
+        csv_path = os.path.join(self.data_dir, 'good_bazis_2024.csv')
+        index_mtime = os.stat(helper.GOOD_BAZI_INDEX).st_mtime
+        os.utime(csv_path, (index_mtime + 10, index_mtime + 10))
+        os.utime(helper.GOOD_BAZI_INDEX, (index_mtime - 10, index_mtime - 10))
+        self.assertIsNone(helper.good_bazis_between(*self.ranges[0]))
+
+
+    def test_rebuild_does_not_cut_off_a_stream_in_progress(self):
+        helper.build_good_bazi_index()
+        expected = _good_bazis_from_csv(*self.ranges[1])
+        dates = helper.good_bazis_between(*self.ranges[1])
+        first = next(dates)
+        index_mtime = os.stat(helper.GOOD_BAZI_INDEX).st_mtime
+        helper.build_good_bazi_index()
+        os.utime(helper.GOOD_BAZI_INDEX, (index_mtime + 10, index_mtime + 10))
+        self.assertIsNotNone(helper.good_bazis_between(*self.ranges[0]))
+        self.assertEqual([first, *dates], expected)
+
+class GoodHoursInDayTest(SimpleTestCase):
+    def assert_days_match_per_hour_bazi(self, start, days):
+        jie_days = 0
+        for offset in range(days):
+            lunar = start.getLunar().next(offset)
+            year, month, day = lunar.getYear(), lunar.getMonth(), lunar.getDay()
+            first = Lunar.fromYmdHms(year, month, day, 0, 0, 0).getEightChar()
+            last = Lunar.fromYmdHms(year, month, day, 23, 0, 0).getEightChar()
+            jie_days += first.getMonth() != last.getMonth()
+            expected = [hour for hour in helper.good_bazi_hours
+                        if helper.is_bazi_good(Lunar.fromYmdHms(year, month, day, hour, 0, 0).getEightChar(), hour)]
+            with self.subTest(lunar=lunar.toString()):
+                self.assertEqual(helper.good_hours_in_day(lunar), expected)
+        return jie_days
+
+    def test_days_across_jie(self):
+        # 立春 (which also turns the year pillar) and 惊蛰 fall during the day in 2024.
+        self.assertEqual(self.assert_days_match_per_hour_bazi(Solar.fromYmdHms(2024, 1, 25, 0, 0, 0), 45), 2)
+
+    def test_julian_leap_day_year(self):
+        start = Solar.fromYmdHms(1000, 2, 15, 0, 0, 0)
+        self.assertEqual(start.getLunar().next(14).getSolar().toYmd(), '1000-02-29')
+        self.assertGreater(self.assert_days_match_per_hour_bazi(start, 30), 0)
+
+
+# The manifest storage needs collectstatic, which the test run does not do.
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class PageMethodsTest(SimpleTestCase):
+    def test_head_is_allowed_on_form_pages(self):
+        for url in ('/zeri', '/bazi'):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.head(url).status_code, 200)
+                self.assertEqual(self.client.put(url).status_code, 405)
@@ -1,21 +1,17 @@
-import csv
+import bisect
 import datetime
-import os
+import itertools
 
 from django.contrib import messages
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
-from django.template.loader import render_to_string
+from django.template.loader import render_to_string, get_template
+from django.views.decorators.http import require_POST, require_http_methods
 
-from fengshui import settings
+from .cache import compute_bazi
 from .forms import BirthTimeForm
-from lunar_python import Lunar, Solar, EightChar, JieQi
-from .constants import gan_wuxing, gan_yinyang
-from .helper import extract_form_data, get_relations, get_wang_xiang, calculate_values, \
-    get_hidden_gans, calculate_wang_xiang_values, calculate_values_for_bazi, calculate_gan_liang_value, \
-    accumulate_wuxing_values, calculate_shenghao, calculate_shenghao_percentage, calculate_shishen_for_bazi, \
-    analyse_partner, get_day_gan_ratio, analyse_personality, analyse_liunian, best_bazi_in_year, calculate_day_guiren, \
-    calculate_year_guiren, calculate_tian_de, calculate_yue_de, calculate_wen_chang, calculate_lu_shen
+from .helper import extract_form_data, analyse_partner, analyse_liunian, good_bazis_between, good_bazis_in_year, \
+    lunar_year_span
 
 
 def home_view(request):
@@ -46,54 +42,70 @@ def introbazi_view(request):
     return render(request, 'introbazi.html')
 
 
+@require_POST
 def get_bazi_detail(request):
-    if request.method == 'POST':
-        year = request.POST.get('year')
-        month = request.POST.get('month')
-        day = request.POST.get('day')
-        hour = request.POST.get('hour')
-        solar = Solar.fromYmdHms(int(year), int(month), int(day), int(hour), 0, 0)
-        lunar = solar.getLunar()
-        bazi = lunar.getEightChar()
-        main_wuxing = bazi.getDayWuXing()[0]
-        values = calculate_values(bazi)
-        hidden_gans = get_hidden_gans(bazi)
-        sheng_hao_relations = get_relations(main_wuxing)
-        wuxing = calculate_values_for_bazi(bazi, gan_wuxing)
-        yinyang = calculate_values_for_bazi(bazi, gan_yinyang)
-        shishen = calculate_shishen_for_bazi(wuxing, yinyang)
-        wang_xiang = get_wang_xiang(bazi.getMonthZhi(), lunar)
-        wang_xiang_values = calculate_wang_xiang_values(bazi, wang_xiang)
-        gan_liang_values = calculate_gan_liang_value(values, hidden_gans, wang_xiang_values)
-        shengxiao = lunar.getYearShengXiaoExact()
-        wuxing_value = accumulate_wuxing_values(wuxing, gan_liang_values)
-        sheng_hao = calculate_shenghao(wuxing_value, main_wuxing)
-        sheng_hao_percentage = calculate_shenghao_percentage(sheng_hao[0], sheng_hao[1])
-        gui_ren = calculate_day_guiren(bazi)
-        # year_gui_ren = calculate_year_guiren(bazi)
-        tian_de = calculate_tian_de(bazi)
-        yue_de = calculate_yue_de(bazi)
-        wen_chang = calculate_wen_chang(bazi)
-        lu_shen = calculate_lu_shen(bazi)
-
-        context = {
-            'bazi': bazi,
-            'wuxing': wuxing,
-            'wuxing_value': wuxing_value,
-            'sheng_hao': sheng_hao,
-            'sheng_hao_percentage': sheng_hao_percentage,
-            'gui_ren': gui_ren,
-            # 'year_gui_ren': year_gui_ren,
-            'tian_de': tian_de,
-            'yue_de': yue_de,
-            'wen_chang': wen_chang,
-            'lu_shen': lu_shen
-        }
-        html = render_to_string('partials/bazi_detail.html', context)
-        return HttpResponse(html)
-    return HttpResponse(status=404)
-
-
+    year = request.POST.get('year')
+    month = request.POST.get('month')
+    day = request.POST.get('day')
+    hour = request.POST.get('hour')
+    bundle = compute_bazi(int(year), int(month), int(day), int(hour), 0)
+    # Clients that ask for JSON only (not the default */* of the zeri page) get the raw values to render themselves.
+    if request.accepts('application/json') and not request.accepts('text/html'):
+        return JsonResponse({
+            'bazi': bundle.bazi.toString().split(),
+            'wuxing': bundle.wuxing,
+            'wuxing_value': bundle.wuxing_value,
+            'sheng_hao': bundle.sheng_hao,
+            'sheng_hao_percentage': bundle.sheng_hao_percentage,
+            'gui_ren': bundle.gui_ren,
+            'tian_de': bundle.tian_de,
+            'yue_de': bundle.yue_de,
+            'wen_chang': bundle.wen_chang,
+            'lu_shen': bundle.lu_shen
+        }, json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')})
+    context = {
+        'bazi': bundle.bazi,
+        'wuxing': bundle.wuxing,
+        'wuxing_value': bundle.wuxing_value,
+        'sheng_hao': bundle.sheng_hao,
+        'sheng_hao_percentage': bundle.sheng_hao_percentage,
+        'gui_ren': bundle.gui_ren,
+        'tian_de': bundle.tian_de,
+        'yue_de': bundle.yue_de,
+        'wen_chang': bundle.wen_chang,
+        'lu_shen': bundle.lu_shen
+    }
+    return HttpResponse(render_to_string('partials/bazi_detail.html', context, request))
+
+
+def _good_bazis_from_csv(from_date, to_date):
+    data = []
+    for year in range(from_date.year - 1, to_date.year + 2):
+        span = lunar_year_span(year)
+        if span is None or span[1] <= from_date or span[0] > to_date:
+            continue
+        dates = good_bazis_in_year(year)
+        data.extend(dates[bisect.bisect_left(dates, from_date):bisect.bisect_right(dates, to_date)])
+    return data
+
+
+ZERI_STREAM_MIN_DAYS = 366
+ZERI_STREAM_CHUNK_ROWS = 200
+ZERI_ROWS_PLACEHOLDER = '<!-- zeri rows -->'
+
+
+def _stream_zeri(prologue, dates, epilogue):
+    """Yield the page around the result rows, pulling dates lazily so long ranges never sit in memory at once."""
+    yield prologue
+    row_template = get_template('partials/zeri_row.html')
+    chunk = list(itertools.islice(dates, ZERI_STREAM_CHUNK_ROWS))
+    while chunk:
+        yield ''.join(row_template.render({'date': date}) for date in chunk)
+        chunk = list(itertools.islice(dates, ZERI_STREAM_CHUNK_ROWS))
+    yield epilogue
+
+
+@require_http_methods(['GET', 'HEAD', 'POST'])
 def zeri_view(request):
     if request.method == 'POST':
         from_date_str = request.POST.get('from_date')
@@ -106,23 +118,40 @@ def zeri_view(request):
             messages.warning(request, '开始日子不能晚于结束日子。')
             return redirect('zeri')
 
-        data = []
-        for year in range(from_date.year - 1, to_date.year + 2):
-            csv_file_path = os.path.join(settings.DATA_DIR, f'good_bazis_{year}.csv')
-            try:
-                with open(csv_file_path, 'r', newline='') as csvfile:
-                    reader = csv.reader(csvfile)
-                    for row in reader:
-                        date = f'{row[0]} {row[1]} {row[2]} {row[3]}'
-                        data_date = datetime.datetime.strptime(date, '%Y %m %d %H')  # Assuming first column has date
-                        if from_date <= data_date <= to_date:
-                            data.append(data_date)
-            except FileNotFoundError:
-                continue
-        return render(request, 'zeri.html', {'data': data, 'from_date': from_date_str, 'to_date': to_date_str})
+        # Fall back to scanning the yearly CSVs while the index is missing or older than them (see load_bazi).
+        dates = good_bazis_between(from_date, to_date)
+        if dates is None:
+            dates = _good_bazis_from_csv(from_date, to_date)
+        dates = iter(dates)
+        context = {'from_date': from_date_str, 'to_date': to_date_str}
+        if (to_date - from_date).days >= ZERI_STREAM_MIN_DAYS:
+            first = next(dates, None)
+            if first is None:
+                return render(request, 'zeri.html', {'data': [], **context})
+            # Render the page shell now, while the CSRF and messages middleware can still see its effects.
+            page = render_to_string('zeri.html', {**context, 'data': True, 'rows_placeholder': ZERI_ROWS_PLACEHOLDER},
+                                    request)
+            prologue, epilogue = page.split(ZERI_ROWS_PLACEHOLDER)
+            return StreamingHttpResponse(_stream_zeri(prologue, itertools.chain([first], dates), epilogue))
+        return render(request, 'zeri.html', {'data': list(dates), **context})
     return render(request, 'zeri.html')
 
 
+def _compute_context(birth, selected_year, is_male, form, years):
+    bundle = compute_bazi(birth['year'], birth['month'], birth['day'], birth['hour'], birth['minute'])
+    is_strong = bundle.sheng_hao[0] > bundle.sheng_hao[1]
+    return {
+        'form': form,
+        **bundle._asdict(),
+        'current_year': int(selected_year),
+        'is_male': is_male,
+        'partner_analyst': analyse_partner(bundle.hidden_gans, bundle.shishen),
+        'liunian_analysis': analyse_liunian(bundle.bazi, bundle.shishen, selected_year, is_strong, is_male),
+        'years': years,
+    }
+
+
+@require_http_methods(['GET', 'HEAD', 'POST'])
 def bazi_view(request):
     current_year = datetime.datetime.now().year
     years = range(current_year - 20, current_year + 50)
@@ -132,50 +161,7 @@ def bazi_view(request):
             data = extract_form_data(form)
             selected_year = request.POST.get('liunian')
             is_male = request.POST.get('gender') == 'male'
-            solar = Solar.fromYmdHms(data['year'], data['month'], data['day'], data['hour'], data['minute'], 0)
-            lunar = solar.getLunar()
-            bazi = lunar.getEightChar()
-            main_wuxing = bazi.getDayWuXing()[0]
-            values = calculate_values(bazi)
-            hidden_gans = get_hidden_gans(bazi)
-            sheng_hao_relations = get_relations(main_wuxing)
-            wuxing = calculate_values_for_bazi(bazi, gan_wuxing)
-            yinyang = calculate_values_for_bazi(bazi, gan_yinyang)
-            shishen = calculate_shishen_for_bazi(wuxing, yinyang)
-            wang_xiang = get_wang_xiang(bazi.getMonthZhi(), lunar)
-            wang_xiang_values = calculate_wang_xiang_values(bazi, wang_xiang)
-            gan_liang_values = calculate_gan_liang_value(values, hidden_gans, wang_xiang_values)
-            shengxiao = lunar.getYearShengXiaoExact()
-            wuxing_value = accumulate_wuxing_values(wuxing, gan_liang_values)
-            sheng_hao = calculate_shenghao(wuxing_value, main_wuxing)
-            sheng_hao_percentage = calculate_shenghao_percentage(sheng_hao[0], sheng_hao[1])
-            is_strong = sheng_hao[0] > sheng_hao[1]
-            partner_analyst = analyse_partner(hidden_gans, shishen)
-            personality = analyse_personality(bazi.getMonthZhi())
-            liunian_analysis = analyse_liunian(bazi, shishen, selected_year, is_strong, is_male)
-            context = {
-                'form': form,
-                'bazi': bazi,
-                'values': values,
-                'hidden_gans': hidden_gans,
-                'main_wuxing': main_wuxing,
-                'shengxiao': shengxiao,
-                'wang_xiang': wang_xiang,
-                'wang_xiang_values': wang_xiang_values,
-                'wuxing': wuxing,
-                'yinyang': yinyang,
-                'shishen': shishen,
-                'gan_liang_values': gan_liang_values,
-                'wuxing_value': wuxing_value,
-                'sheng_hao': sheng_hao,
-                'sheng_hao_percentage': sheng_hao_percentage,
-                'current_year': int(selected_year),
-                'is_male': is_male,
-                'partner_analyst': partner_analyst,
-                'liunian_analysis': liunian_analysis,
-                'years': years,
-                'personality': personality
-            }
+            context = _compute_context(data, selected_year, is_male, form, years)
             return render(request, 'bazi.html', context)
     else:
         form = BirthTimeForm()
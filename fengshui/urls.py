@@ -14,21 +14,43 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import functools
+
 from django.contrib import admin
 from django.urls import path
-from bazi.views import bazi_view, home_view, wuxing_view, tiangan_view, yinyang_view, dizhi_view, ganzhi_view, \
-    introbazi_view, zeri_view, get_bazi_detail
+from django.utils.module_loading import import_string
+
+
+def lazy_view(dotted_path):
+    """Import the view on its first request, so loading the URLconf does not pull in bazi.views and lunar_python.
+
+    The wrapper takes the view's module and name for resolve() and debug pages, but attributes that decorators set
+    on the real view (csrf_exempt and the like) are not visible to middleware through it; route such views eagerly.
+    """
+    module_name, view_name = dotted_path.rsplit('.', 1)
+
+    @functools.lru_cache(maxsize=1)
+    def load():
+        return import_string(dotted_path)
+
+    def view(request, *args, **kwargs):
+        return load()(request, *args, **kwargs)
+
+    view.__module__ = module_name
+    view.__name__ = view.__qualname__ = view_name
+    return view
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('', home_view, name='home'),
-    path('bazi', bazi_view, name='bazi'),
-    path('wuxing', wuxing_view, name='wuxing'),
-    path('yinyang', yinyang_view, name='yinyang'),
-    path('tiangan', tiangan_view, name='tiangan'),
-    path('dizhi', dizhi_view, name='dizhi'),
-    path('ganzhi', ganzhi_view, name='ganzhi'),
-    path('introbazi', introbazi_view, name='introbazi'),
-    path('zeri', zeri_view, name='zeri'),
-    path('bazi_detail', get_bazi_detail, name='bazi_detail')
+    path('', lazy_view('bazi.views.home_view'), name='home'),
+    path('bazi', lazy_view('bazi.views.bazi_view'), name='bazi'),
+    path('wuxing', lazy_view('bazi.views.wuxing_view'), name='wuxing'),
+    path('yinyang', lazy_view('bazi.views.yinyang_view'), name='yinyang'),
+    path('tiangan', lazy_view('bazi.views.tiangan_view'), name='tiangan'),
+    path('dizhi', lazy_view('bazi.views.dizhi_view'), name='dizhi'),
+    path('ganzhi', lazy_view('bazi.views.ganzhi_view'), name='ganzhi'),
+    path('introbazi', lazy_view('bazi.views.introbazi_view'), name='introbazi'),
+    path('zeri', lazy_view('bazi.views.zeri_view'), name='zeri'),
+    path('bazi_detail', lazy_view('bazi.views.get_bazi_detail'), name='bazi_detail')
 ]